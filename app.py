@@ -1,29 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-import sqlite3
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort
 import hashlib
+import hmac
 import os
 from werkzeug.security import generate_password_hash, check_password_hash
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from database import DatabaseManager, MIN_SEARCH_TEXT
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Generate a random secret key
 
 DATABASE = 'users.db'
+app.config['DATABASE'] = DATABASE
+# opened on first use, so importers (the benchmark) can point DATABASE elsewhere first
+_db = None
+_db_lock = threading.Lock()
 
-def init_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            password_md5 TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
+USERS_PER_PAGE = 50
+
+# chat log search is off unless a token is configured, moderators send it as X-Moderation-Token
+MODERATION_TOKEN = os.environ.get('MODERATION_TOKEN', '')
+MESSAGES_PER_PAGE = 100
+
+# password hashing runs off the request thread, bounded to HASH_WORKERS running plus HASH_QUEUE waiting
+HASH_WORKERS = 4
+HASH_QUEUE = 32
+hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+hash_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE)
+
+def get_db():
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = DatabaseManager(app.config['DATABASE'])
+    return _db
 
 def validate_username(username):
     if not username:
@@ -52,38 +64,40 @@ def validate_password(password):
     
     return True, ""
 
-def get_user_by_username(username):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+def _hash_password(password):
+    # pbkdf2 is slow on purpose; hashlib drops the GIL while it runs
+    password_hash = generate_password_hash(password)
+    
+    # MD5 for osu
+    password_md5 = hashlib.md5(password.encode('utf-8')).hexdigest()
+    return password_hash, password_md5
+
+def hash_password(password):
+    # past the queue a registration is turned away at once instead of tying up a worker.
+    # the request thread still waits for its own hash, a few hundred ms
+    if not hash_slots.acquire(blocking=False):
+        return None
+    try:
+        future = hash_pool.submit(_hash_password, password)
+    except Exception:
+        hash_slots.release()
+        raise
+    future.add_done_callback(lambda f: hash_slots.release())
+    return future.result()
 
 def create_user(username, password):
+    hashes = hash_password(password)
+    if hashes is None:
+        return False, "Server is busy, please try again in a moment"
+    
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Hash password
-        password_hash = generate_password_hash(password)
-        
-        # MD5 for osu
-        password_md5 = hashlib.md5(password.encode('utf-8')).hexdigest()
-        
-        cursor.execute('''
-            INSERT INTO users (username, password_hash, password_md5) 
-            VALUES (?, ?, ?)
-        ''', (username, password_hash, password_md5))
-        
-        conn.commit()
-        user_id = cursor.lastrowid
-        conn.close()
-        return True, user_id
-    except sqlite3.IntegrityError:
-        return False, "Username already exists"
+        user_id = get_db().create_user(username, *hashes)
     except Exception as e:
         return False, f"Database error: {str(e)}"
+    
+    if user_id is None:
+        return False, "Username already exists"
+    return True, user_id
 
 @app.route('/')
 def index():
@@ -111,10 +125,6 @@ def register():
             flash('Passwords do not match', 'error')
             return render_template('register.html')
         
-        if get_user_by_username(username):
-            flash('Username already exists', 'error')
-            return render_template('register.html')
-        
         success, result = create_user(username, password)
         if success:
             flash(f'Registration successful! Welcome, {username}!', 'success')
@@ -135,12 +145,49 @@ def success():
 
 @app.route('/users')
 def list_users():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, username, created_at FROM users ORDER BY created_at DESC')
-    users = cursor.fetchall()
-    conn.close()
-    return render_template('users.html', users=users)
+    before = None
+    before_id = request.args.get('before_id', type=int)
+    if before_id is not None:
+        before = (request.args.get('before', ''), before_id)
+    
+    users = get_db().get_users_page(limit=USERS_PER_PAGE, before=before)
+    next_page = None
+    if len(users) == USERS_PER_PAGE:
+        next_page = url_for('list_users', before=users[-1].created_at, before_id=users[-1].id)
+    
+    return render_template('users.html', users=users, total=get_db().count_users(), next_page=next_page)
+
+@app.route('/moderation/messages')
+def search_messages():
+    token = request.headers.get('X-Moderation-Token', '')
+    if not MODERATION_TOKEN or not hmac.compare_digest(token, MODERATION_TOKEN):
+        abort(404)
+    
+    sender = request.args.get('sender')
+    channel = request.args.get('channel')
+    text = request.args.get('q')
+    if text and len(text) < MIN_SEARCH_TEXT and not sender and not channel:
+        return jsonify({'error': f'q needs at least {MIN_SEARCH_TEXT} characters unless sender or channel is given'}), 400
+    
+    messages = get_db().search_messages(
+        sender=sender,
+        target=channel,
+        text=text,
+        before_id=request.args.get('before_id', type=int),
+        limit=max(1, min(request.args.get('limit', MESSAGES_PER_PAGE, type=int), MESSAGES_PER_PAGE))
+    )
+    
+    return jsonify({
+        'messages': [{
+            'id': m.id,
+            'sender': m.sender,
+            'sender_id': m.sender_id,
+            'channel': m.target,
+            'content': m.content,
+            'timestamp': m.timestamp.isoformat(),
+        } for m in messages],
+        'next_before_id': messages[-1].id if len(messages) else None,
+    })
 
 @app.route('/logout')
 def logout():
@@ -149,5 +196,4 @@ def logout():
     return redirect(url_for('index'))
 
 if __name__ == '__main__':
-    init_db()
     app.run(debug=True, host='127.0.0.1', port=5000)
\ No newline at end of file
@@ -0,0 +1,340 @@
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from database import DatabaseManager
+from handlers import LoginHandler, PacketHandler, TokenManager
+from models import UserData
+from protocol import BanchoProtocol, PacketBuilder
+
+
+ONLINE_USERS = 200
+BENCH_PASSWORD_MD5 = "5f4dcc3b5aa765d61d8327deb882cf99"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# the login limiter lets one address burst 10 logins, stay under it
+SCALING_USERS = 10
+
+
+def _packet(packet_id: int, content: bytes) -> bytes:
+    return BanchoProtocol.create_packet(packet_id, content)
+
+
+def _status_body() -> bytes:
+    content = (
+        bytes([2]) +
+        BanchoProtocol.write_string("Playing some map") +
+        BanchoProtocol.write_string("d41d8cd98f00b204e9800998ecf8427e") +
+        (64).to_bytes(4, 'little') +
+        bytes([0]) +
+        (1234).to_bytes(4, 'little')
+    )
+    return _packet(0, content)
+
+
+def _chat_body() -> bytes:
+    content = (
+        BanchoProtocol.write_string("#osu") +
+        BanchoProtocol.write_string("hello everyone, how is it going") +
+        BanchoProtocol.write_string("")
+    )
+    return _packet(25, content)
+
+
+def build_corpora() -> Dict[str, bytes]:
+    pong = _packet(4, b'')
+    return {
+        "login": b"bench_user\n" + BENCH_PASSWORD_MD5.encode() + b"\nb20250101|0|1|abc:def|0\n",
+        "pong_poll": pong,
+        "mixed_poll": pong + _status_body() + _chat_body() + _packet(85, BanchoProtocol.write_int_list(list(range(1, 33)))) + pong,
+    }
+
+
+def _populate(token_manager: TokenManager, count: int) -> List[str]:
+    return [token_manager.add_user(UserData(user_id, f"user{user_id}"))
+            for user_id in range(1, count + 1)]
+
+
+def _time(func: Callable[[], object], number: int, repeat: int,
+          setup: Optional[Callable[[], object]] = None) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return timings
+
+
+def build_benchmarks(db_path: str) -> Tuple[Dict[str, Callable[[], object]], Dict[str, Callable[[], object]]]:
+    corpora = build_corpora()
+
+    db_manager = DatabaseManager(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "INSERT OR IGNORE INTO users (username, password_hash, password_md5) VALUES (?, ?, ?)",
+        ("bench_user", "x", BENCH_PASSWORD_MD5))
+    conn.commit()
+    conn.close()
+
+    token_manager = TokenManager()
+    tokens = _populate(token_manager, ONLINE_USERS)
+    user = token_manager.get_user(tokens[0])
+    packet_handler = PacketHandler(token_manager)
+
+    user_ids = list(range(1, ONLINE_USERS + 1))
+    encoded_string = BanchoProtocol.write_string("some status text for the stream")
+    encoded_list = BanchoProtocol.write_int_list(user_ids)
+
+    def login():
+        login_handler = LoginHandler(db_manager, token_manager)
+        login_handler.handle_login(corpora["login"])
+
+    def drain_queues():
+        # broadcasts fill every other session's queue, start each sample from empty ones
+        for token in tokens:
+            token_manager.dequeue(token)
+
+    benchmarks = {
+        "write_string": lambda: BanchoProtocol.write_string("some status text for the stream"),
+        "read_bancho_string": lambda: BanchoProtocol.read_bancho_string_from_stream(io.BytesIO(encoded_string)),
+        "write_int_list": lambda: BanchoProtocol.write_int_list(user_ids),
+        "read_int_list": lambda: BanchoProtocol.read_int_list_from_stream(io.BytesIO(encoded_list)),
+        "user_stats": lambda: PacketBuilder.user_stats(
+            1, 2, "Playing", "d41d8cd98f00b204e9800998ecf8427e", 64, 0, 1234,
+            ranked_score=5000000, accuracy=97.54, playcount=123,
+            total_score=8000000, rank=2100, pp=2100),
+        "user_presence": lambda: PacketBuilder.user_presence(1, "user1", 5, 94, 4, 0, 0.0, 0.0, 2100),
+        "process_packets_pong": lambda: packet_handler.process_packets(user, corpora["pong_poll"]),
+        "process_packets_mixed": lambda: packet_handler.process_packets(user, corpora["mixed_poll"]),
+        "login_response": lambda: LoginHandler(db_manager, token_manager)._build_login_response(1, "user1"),
+        "login": login,
+    }
+    setups = {
+        "process_packets_mixed": drain_queues,
+    }
+    return benchmarks, setups
+
+
+def run(number: int, repeat: int, only: List[str]) -> Dict[str, Dict[str, float]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # handlers log every packet; keep that out of the timings and the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            benchmarks, setups = build_benchmarks(os.path.join(tmp, "bench.db"))
+            for name, func in benchmarks.items():
+                if only and name not in only:
+                    continue
+                timings = _time(func, number, repeat, setups.get(name))
+                results[name] = {
+                    "min": min(timings),
+                    "median": statistics.median(timings),
+                }
+    return results
+
+
+def measure_session_memory(count: int = 5000) -> float:
+    # everything a live session keeps: UserData, the token key and its queue
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        token_manager = TokenManager()
+        before = tracemalloc.get_traced_memory()[0]
+        _populate(token_manager, count)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return (after - before) / count
+
+
+def measure_registrations(count: int = 50, concurrency: int = 8) -> float:
+    # full /register round trips through the flask test client, hashing included
+    try:
+        import app as web_app
+    except ImportError:
+        return 0.0
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the app opens its database on first use, nothing touches users.db
+        web_app.app.config['DATABASE'] = os.path.join(tmp, "register.db")
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            web_app.get_db()
+
+        def register(index: int) -> int:
+            client = web_app.app.test_client()
+            response = client.post('/register', data={
+                'username': f"bench{index}",
+                'password': "benchpassword",
+                'confirm_password': "benchpassword",
+            })
+            return response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(register, range(count)))
+        elapsed = time.perf_counter() - start
+
+    return count / elapsed
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _post(port: int, body: bytes, token: Optional[str] = None) -> http.client.HTTPResponse:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("POST", "/", body=body, headers={"osu-token": token} if token else {})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response
+
+
+def _poll_client(args: tuple) -> int:
+    port, tokens, seconds = args
+    pong = _packet(4, b'')
+    # every tenth poll asks for everyone's presence, the call that crosses the broker the most
+    receive_updates = pong + _packet(79, b'')
+    polls = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        body = receive_updates if polls % 10 == 0 else pong
+        _post(port, body, tokens[polls % len(tokens)])
+        polls += 1
+    return polls
+
+
+def measure_scaling(worker_counts: List[int], seconds: float = 5.0, clients: int = 8) -> Dict[int, float]:
+    # polls per second against a real server.py for each worker count, the clients run in their own processes
+    rates = {}
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                DatabaseManager(os.path.join(tmp, "users.db"))
+            conn = sqlite3.connect(os.path.join(tmp, "users.db"))
+            conn.executemany(
+                "INSERT INTO users (username, password_hash, password_md5) VALUES (?, ?, ?)",
+                [(f"load{index}", "x", BENCH_PASSWORD_MD5) for index in range(SCALING_USERS)])
+            conn.commit()
+            conn.close()
+
+            port = _free_port()
+            server = subprocess.Popen(
+                [sys.executable, os.path.join(BASE_DIR, "server.py"), "--port", str(port), "--workers", str(workers)],
+                cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                deadline = time.monotonic() + 10
+                while True:
+                    try:
+                        socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                        break
+                    except OSError:
+                        if time.monotonic() > deadline:
+                            raise RuntimeError(f"server with {workers} worker(s) did not come up")
+                        time.sleep(0.05)
+
+                tokens = []
+                for index in range(SCALING_USERS):
+                    body = f"load{index}\n{BENCH_PASSWORD_MD5}\nb20250101|0|1|abc:def|0\n".encode()
+                    token = _post(port, body).getheader("cho-token")
+                    if token:
+                        tokens.append(token)
+                if not tokens:
+                    raise RuntimeError("no load client could log in")
+
+                with multiprocessing.Pool(clients) as pool:
+                    polls = sum(pool.map(_poll_client, [(port, tokens, seconds)] * clients))
+                rates[workers] = polls / seconds
+            finally:
+                server.terminate()
+                server.wait(timeout=15)
+    return rates
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"  {name:<24} {result['min'] * 1e6:10.2f} us   (no baseline)")
+            continue
+        # min is the least noisy sample for sub-microsecond calls
+        before = baseline[name]["min"]
+        change = (result["min"] - before) / before * 100.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"  {name:<24} {result['min'] * 1e6:10.2f} us   {change:+7.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="micro-benchmarks for the bancho protocol hot paths")
+    parser.add_argument("--number", type=int, default=200, help="calls per timing sample")
+    parser.add_argument("--repeat", type=int, default=5, help="timing samples per benchmark")
+    parser.add_argument("--save", metavar="FILE", help="write results as a baseline json")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    parser.add_argument("--memory", action="store_true", help="also report memory per session")
+    parser.add_argument("--register", action="store_true", help="also report /register throughput (needs flask)")
+    parser.add_argument("--scaling", metavar="N", type=int, nargs="+",
+                        help="also report polls/s against server.py with each of these worker counts")
+    parser.add_argument("only", nargs="*", help="benchmark names to run (default: all)")
+    args = parser.parse_args()
+
+    results = run(args.number, args.repeat, args.only)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"compared to {args.compare} (threshold {args.threshold:.1f}%):")
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        regressions = []
+        for name, result in results.items():
+            print(f"  {name:<24} {result['median'] * 1e6:10.2f} us   (min {result['min'] * 1e6:.2f} us)")
+
+    if args.memory:
+        print(f"  {'memory_per_session':<24} {measure_session_memory():10.0f} bytes")
+
+    if args.register:
+        rate = measure_registrations()
+        if rate:
+            print(f"  {'registrations':<24} {rate:10.1f} /s")
+        else:
+            print("  registrations            skipped, flask is not installed")
+
+    if args.scaling:
+        rates = measure_scaling(args.scaling)
+        first = rates[args.scaling[0]]
+        for workers, rate in rates.items():
+            print(f"  {f'polls_{workers}_workers':<24} {rate:10.1f} /s   ({rate / first:.2f}x)")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to {args.save}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import queue
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, Iterable, List
+from models import Message
+from handlers import LOGIN_CHANNELS
+
+
+class ChatLog:
+    # append-only chat history: the last history_size messages per channel stay in memory for
+    # join backfill, everything goes to SQLite in batches from a background thread.
+    # only the server's own channels are logged, a client can't make up new ones
+
+    def __init__(self, db_manager, channels: Iterable[str] = tuple(name for name, _ in LOGIN_CHANNELS),
+                 history_size: int = 50, batch_size: int = 200,
+                 flush_interval: float = 1.0, max_pending: int = 10000):
+        self.db_manager = db_manager
+        self.history_size = history_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.history: Dict[str, Deque[Message]] = {name: deque(maxlen=history_size) for name in channels}
+        self.pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.writer_thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        # picks up where the log left off, done here so the packet path never reads the database
+        for name in self.history:
+            loaded = self._load_history(name)
+            with self.lock:
+                loaded.extend(self.history[name])
+                self.history[name] = loaded
+
+        self.stopping.clear()
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.writer_thread:
+            self.writer_thread.join(timeout=5)
+            self.writer_thread = None
+
+        batch = self._drain()
+        while batch:
+            self._flush(batch)
+            batch = self._drain()
+
+    def append(self, message: Message):
+        if message.target not in self.history:
+            return
+        if message.timestamp is None:
+            message.timestamp = datetime.now(timezone.utc)
+
+        with self.lock:
+            self.history[message.target].append(message)
+
+        # never wait on the database from the packet path, a full backlog drops instead
+        try:
+            self.pending.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def recent(self, target: str) -> List[Message]:
+        with self.lock:
+            channel = self.history.get(target)
+            return list(channel) if channel is not None else []
+
+    def _load_history(self, target: str) -> Deque[Message]:
+        return deque(self.db_manager.get_recent_messages(target, self.history_size),
+                     maxlen=self.history_size)
+
+    def _drain(self) -> List[Message]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        while not self.stopping.is_set():
+            try:
+                batch = [self.pending.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            batch.extend(self._drain())
+            self._flush(batch)
+
+    def _flush(self, batch: List[Message]):
+        if not batch:
+            return
+        if not self.db_manager.add_messages(batch):
+            print(f"chat log lost {len(batch)} message(s)")
+        if self.dropped:
+            print(f"chat log dropped {self.dropped} message(s), writer fell behind")
+            self.dropped = 0
@@ -0,0 +1,163 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import multiprocessing
+from dataclasses import replace
+from multiprocessing.managers import BaseManager
+from typing import List, Optional
+from handlers import TokenManager
+from chat import ChatLog
+from database import DatabaseManager
+from ratelimit import LoginLimiter
+from models import UserData
+from server import OsuServer
+from snapshot import save_snapshot, load_snapshot
+
+
+class SharedTokenManager(TokenManager):
+    # lookups are pickled across the broker socket on every poll, and presence/stats
+    # never read the friend or watching sets, so they stay behind in the broker
+
+    def get_users_by_ids(self, user_ids) -> List[UserData]:
+        return [replace(user, friends=set(), watching=set()) for user in super().get_users_by_ids(user_ids)]
+
+
+# served from the broker process, every worker talks to these instances
+_shared_token_manager = SharedTokenManager()
+# one set of buckets for the cluster, per-worker limiters would multiply the budget by --workers
+_shared_login_limiter = LoginLimiter()
+_shared_chat_log: Optional[ChatLog] = None
+
+
+def _get_token_manager() -> TokenManager:
+    return _shared_token_manager
+
+
+def _get_chat_log() -> ChatLog:
+    return _shared_chat_log
+
+
+def _get_login_limiter() -> LoginLimiter:
+    return _shared_login_limiter
+
+
+def _master_alive(master_pid: int) -> bool:
+    # an orphan is re-parented (to init or a subreaper), so a changed parent means the master died
+    return os.getppid() == master_pid
+
+
+def _watch_master(master_pid: int):
+    while _master_alive(master_pid):
+        time.sleep(0.5)
+    print("master gone, session store exiting")
+    _shared_chat_log.stop()
+    os._exit(0)
+
+
+def _init_broker():
+    global _shared_chat_log
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # one chat log for the whole cluster so join backfill sees every worker's messages
+    _shared_chat_log = ChatLog(DatabaseManager())
+    _shared_chat_log.start()
+    threading.Thread(target=_watch_master, args=(os.getppid(),), daemon=True).start()
+
+
+class SessionStoreManager(BaseManager):
+    pass
+
+
+SessionStoreManager.register('token_manager', callable=_get_token_manager)
+SessionStoreManager.register('chat_log', callable=_get_chat_log)
+SessionStoreManager.register('login_limiter', callable=_get_login_limiter)
+
+
+def _run_worker(index: int, host: str, port: int, address: str, presence_filter: bool):
+    # the master owns ctrl+c and tells us to drain with SIGTERM
+    master_pid = os.getppid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopping.set())
+
+    store = SessionStoreManager(address=address)
+    store.connect()
+
+    # the master snapshots the shared store, not each worker
+    server = OsuServer(host, port, token_manager=store.token_manager(),
+                       reuse_port=True, print_stats=index == 0, snapshot_path=None,
+                       presence_filter=presence_filter, chat_log=store.chat_log(),
+                       login_limiter=store.login_limiter())
+    server.start()
+    print(f"worker {index} up (pid {os.getpid()})")
+
+    # a worker left behind by a killed master would keep the port next to a restarted cluster's
+    # workers with a different session store, so it goes down with the master
+    while not stopping.wait(0.5):
+        if not _master_alive(master_pid):
+            print(f"worker {index}: master gone, exiting")
+            break
+    server.stop()
+
+
+class OsuCluster:
+    # pre-fork master: one session store broker on a unix socket plus N workers
+    # bound to the same port with SO_REUSEPORT.
+    # experimental: every poll makes at least two round trips to the single broker process,
+    # so whether this beats one process depends on the host, measure with benchmark.py --scaling
+
+    def __init__(self, host='127.0.0.1', port=13381, workers=4, snapshot_path='sessions.snapshot',
+                 presence_filter=False):
+        self.host = host
+        self.port = port
+        self.worker_count = workers
+        self.snapshot_path = snapshot_path
+        self.presence_filter = presence_filter
+        self.workers: List[multiprocessing.Process] = []
+        self.store: Optional[SessionStoreManager] = None
+        self.socket_dir = None
+        self.running = False
+
+    def start(self):
+        self.socket_dir = tempfile.mkdtemp(prefix="osu-bancho-")
+        address = os.path.join(self.socket_dir, "sessions.sock")
+
+        self.store = SessionStoreManager(address=address)
+        self.store.start(_init_broker)
+        print(f"session store on {address}")
+        if self.snapshot_path:
+            load_snapshot(self.store.token_manager(), self.snapshot_path)
+
+        for index in range(self.worker_count):
+            worker = multiprocessing.Process(
+                target=_run_worker, args=(index, self.host, self.port, address, self.presence_filter), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.running = True
+        print(f"{self.worker_count} workers on: http://{self.host}:{self.port}/")
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join(timeout=2)
+        self.workers = []
+
+        if self.store:
+            if self.snapshot_path:
+                save_snapshot(self.store.token_manager(), self.snapshot_path)
+            self.store.chat_log().stop()
+            self.store.shutdown()
+            self.store = None
+        if self.socket_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
+        print("stopped")
@@ -1,42 +1,86 @@
+import queue
 import sqlite3
-from typing import Optional, List
-from models import UserInfo
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional, List, Set
+from models import UserInfo, Message
+from migrations import migrate
 import hashlib
 
+# same layout as sqlite's CURRENT_TIMESTAMP, UTC
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# the trigram index can't match anything shorter, such searches need a sender or channel to narrow them
+MIN_SEARCH_TEXT = 3
+
 class DatabaseManager:
-    def __init__(self, db_path='users.db'):
+    # the server and the web app each cache the count, so a write in one shows up in the other after this
+    USER_COUNT_TTL = 30
+    
+    def __init__(self, db_path='users.db', pool_size=8):
         self.db_path = db_path
+        # idle connections kept around, the server and the web app both borrow from here
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.user_count: Optional[int] = None
+        self.user_count_at = 0.0
         self.init_db()
     
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+        
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self.pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
     def init_db(self):
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    password_md5 TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            conn.commit()
-            conn.close()
+            with self.connection() as conn:
+                # readers (logins, /users) keep going while registrations write
+                conn.execute('PRAGMA journal_mode=WAL').fetchall()
+                migrate(conn)
             print(f"db init sucess {self.db_path}")
         except Exception as e:
             print(f"db init error : {e}")
     
+    def create_user(self, username: str, password_hash: str, password_md5: str) -> Optional[int]:
+        # no lookup first, the UNIQUE constraint on username is the duplicate check
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO users (username, password_hash, password_md5) 
+                    VALUES (?, ?, ?)
+                ''', (username, password_hash, password_md5))
+                conn.commit()
+                user_id = cursor.lastrowid
+        except sqlite3.IntegrityError:
+            return None
+        
+        if self.user_count is not None:
+            self.user_count += 1
+        return user_id
+    
     def validate_user(self, username: str, password_md5: str) -> Optional[int]:
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id FROM users 
-                WHERE username = ? AND password_md5 = ?
-            ''', (username, password_md5))
-            result = cursor.fetchone()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id FROM users 
+                    WHERE username = ? AND password_md5 = ?
+                ''', (username, password_md5))
+                result = cursor.fetchone()
             
             if result:
                 return result[0]
@@ -47,14 +91,13 @@ class DatabaseManager:
     
     def get_user_info(self, user_id: int) -> Optional[UserInfo]:
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, username, created_at FROM users 
-                WHERE id = ?
-            ''', (user_id,))
-            result = cursor.fetchone()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, username, created_at FROM users 
+                    WHERE id = ?
+                ''', (user_id,))
+                result = cursor.fetchone()
             
             if result:
                 return UserInfo(
@@ -69,16 +112,186 @@ class DatabaseManager:
     
     def get_all_users(self) -> List[UserInfo]:
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, username, created_at FROM users 
-                ORDER BY created_at DESC
-            ''')
-            results = cursor.fetchall()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, username, created_at FROM users 
+                    ORDER BY created_at DESC
+                ''')
+                results = cursor.fetchall()
             
             return [UserInfo(id=r[0], username=r[1], created_at=r[2]) for r in results]
         except Exception as e:
             print(f"db all users error: {e}")
-            return []
\ No newline at end of file
+            return []
+    
+    def get_users_page(self, limit: int = 50, before: Optional[tuple] = None) -> List[UserInfo]:
+        # keyset pagination: before is the (created_at, id) of the last user on the previous page
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                if before:
+                    cursor.execute('''
+                        SELECT id, username, created_at FROM users 
+                        WHERE (created_at, id) < (?, ?)
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT ?
+                    ''', (before[0], before[1], limit))
+                else:
+                    cursor.execute('''
+                        SELECT id, username, created_at FROM users 
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT ?
+                    ''', (limit,))
+                results = cursor.fetchall()
+            
+            return [UserInfo(id=r[0], username=r[1], created_at=r[2]) for r in results]
+        except Exception as e:
+            print(f"db users page error: {e}")
+            return []
+    
+    def count_users(self) -> int:
+        now = time.monotonic()
+        if self.user_count is not None and now - self.user_count_at < self.USER_COUNT_TTL:
+            return self.user_count
+        
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT COUNT(*) FROM users')
+                self.user_count = cursor.fetchone()[0]
+            self.user_count_at = now
+            return self.user_count
+        except Exception as e:
+            print(f"db count users error: {e}")
+            return self.user_count or 0
+    
+    def get_friends(self, user_id: int) -> Set[int]:
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT friend_id FROM friends 
+                    WHERE user_id = ?
+                ''', (user_id,))
+                results = cursor.fetchall()
+            
+            return {r[0] for r in results}
+        except Exception as e:
+            print(f"db friends error: {e}")
+            return set()
+    
+    def add_friend(self, user_id: int, friend_id: int) -> bool:
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT OR IGNORE INTO friends (user_id, friend_id) 
+                    VALUES (?, ?)
+                ''', (user_id, friend_id))
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"db add friend error: {e}")
+            return False
+    
+    def remove_friend(self, user_id: int, friend_id: int) -> bool:
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM friends 
+                    WHERE user_id = ? AND friend_id = ?
+                ''', (user_id, friend_id))
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"db remove friend error: {e}")
+            return False
+    
+    def add_messages(self, messages: List[Message]) -> bool:
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT INTO messages (sender_id, sender, target, content, created_at) 
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(m.sender_id, m.sender, m.target, m.content, m.timestamp.strftime(TIMESTAMP_FORMAT))
+                      for m in messages])
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"db add messages error: {e}")
+            return False
+    
+    def get_recent_messages(self, target: str, limit: int) -> List[Message]:
+        # oldest first, ready to replay
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, sender_id, sender, target, content, created_at FROM messages 
+                    WHERE target = ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (target, limit))
+                results = cursor.fetchall()
+            
+            return [self._message(r) for r in reversed(results)]
+        except Exception as e:
+            print(f"db recent messages error: {e}")
+            return []
+    
+    def search_messages(self, sender: Optional[str] = None, target: Optional[str] = None,
+                        text: Optional[str] = None, before_id: Optional[int] = None,
+                        limit: int = 50) -> List[Message]:
+        # sender and target hit their indexes, text goes through the trigram index (messages_fts).
+        # text shorter than MIN_SEARCH_TEXT only filters what sender/target narrow down to
+        conditions = []
+        params = []
+        if sender:
+            conditions.append('sender = ? COLLATE NOCASE')
+            params.append(sender)
+        if target:
+            conditions.append('target = ?')
+            params.append(target)
+        if text and len(text) >= MIN_SEARCH_TEXT:
+            conditions.append('id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)')
+            # one quoted phrase, the client's text is never read as query syntax
+            params.append('"' + text.replace('"', '""') + '"')
+        elif text:
+            if not sender and not target:
+                return []
+            conditions.append("content LIKE ? ESCAPE '\\'")
+            escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params.append(f"%{escaped}%")
+        if before_id:
+            conditions.append('id < ?')
+            params.append(before_id)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    SELECT id, sender_id, sender, target, content, created_at FROM messages 
+                    {where}
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (*params, limit))
+                results = cursor.fetchall()
+            
+            return [self._message(r) for r in results]
+        except Exception as e:
+            print(f"db search messages error: {e}")
+            return []
+    
+    def _message(self, row) -> Message:
+        return Message(
+            sender=row[2],
+            sender_id=row[1],
+            target=row[3],
+            content=row[4],
+            timestamp=datetime.strptime(row[5], TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc),
+            id=row[0]
+        )
@@ -1,307 +1,374 @@
-import io
-import struct
-from typing import Optional, Dict, List
+import secrets
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Optional, Dict, List, Set
 from models import UserData, Message, Channel
-from protocol import BanchoProtocol, PacketBuilder
+from protocol import PacketBuilder, PacketReader
+
+
+# login response segments that are the same for everyone, encoded once
+PROTOCOL_NEGOTIATION = PacketBuilder.protocol_negotiation(19)
+LOGIN_PERMISSIONS = PacketBuilder.login_permissions(4)
+LOGIN_FAILED = PacketBuilder.login_reply(-1)
+LOGIN_BUSY = PacketBuilder.notification("Too many login attempts, please try again in a moment.")
+EMPTY_FRIENDS_LIST = PacketBuilder.friends_list([])
+
+# (name, description) of the channels every client is put in
+LOGIN_CHANNELS = (("#osu", "Main chat"),)
+
+
+@lru_cache(maxsize=64)
+def channel_segment(user_count: int) -> bytes:
+    # only the user count varies, call cache_clear() if LOGIN_CHANNELS changes
+    segment = bytearray()
+    for name, description in LOGIN_CHANNELS:
+        segment.extend(PacketBuilder.channel_join_success(name))
+        segment.extend(PacketBuilder.channel_available(Channel(name, description, user_count, False)))
+        segment.extend(PacketBuilder.channel_available(Channel(name, description, user_count, True)))
+    segment.extend(PacketBuilder.channel_info_complete())
+    return bytes(segment)
+
+
+def user_presence_packet(user: UserData) -> bytes:
+    return PacketBuilder.user_presence(user.user_id, user.username, 5, 94, 4, 0, 0.0, 0.0, 2100)
+
+
+def user_stats_packet(user: UserData) -> bytes:
+    return PacketBuilder.user_stats(
+        user.user_id, user.status, user.status_text,
+        user.beatmap_md5, user.mods, user.mode,
+        user.beatmap_id, ranked_score=5000000, accuracy=97.54,
+        playcount=123, total_score=8000000, rank=2100, pp=2100)
+
+
+def channel_backfill(chat_log, channel_name: str) -> List[bytes]:
+    return [PacketBuilder.send_message(message.target, message.content, message.sender, message.sender_id)
+            for message in chat_log.recent(channel_name)]
+
+
+def online_ids_friends_first(online_ids: List[int], friends: Set[int], exclude_user_id: int) -> List[int]:
+    # friends lead so clients that stop reading early still get the presences that matter
+    online_friends = []
+    others = []
+    for online_id in online_ids:
+        if online_id == exclude_user_id:
+            continue
+        if online_id in friends:
+            online_friends.append(online_id)
+        else:
+            others.append(online_id)
+    return online_friends + others
+
+
+def online_presence(token_manager, user_id: int, friends: Set[int], presence_filter: bool) -> tuple[List[int], List[bytes]]:
+    # ids for the presence bundle, plus presence/stats for whoever is sent in full:
+    # friends only with the presence filter on, everyone else online otherwise.
+    # ids first, then one batch lookup, the session store never hands out its whole dict
+    online_ids = online_ids_friends_first(token_manager.get_online_user_ids(), friends, user_id)
+    packets = []
+    for online_user in token_manager.get_users_by_ids(friends if presence_filter else online_ids):
+        packets.append(user_presence_packet(online_user))
+        packets.append(user_stats_packet(online_user))
+    return online_ids, packets
 
 
 class LoginHandler:
     
-    def __init__(self, db_manager, token_manager):
+    def __init__(self, db_manager, token_manager, login_limiter=None, presence_filter=False, chat_log=None):
         self.db_manager = db_manager
         self.token_manager = token_manager
+        self.login_limiter = login_limiter
+        self.chat_log = chat_log
+        # only friends get full presence/stats up front, everyone else is just an id in the bundle
+        self.presence_filter = presence_filter
     
-    def handle_login(self, body: bytes) -> tuple[bool, bytes, Optional[str]]:
+    def _reject_busy(self) -> tuple[bool, List[bytes], Optional[str]]:
+        return False, [LOGIN_BUSY, LOGIN_FAILED], None
+    
+    def handle_login(self, body: bytes, client_ip: str = "") -> tuple[bool, List[bytes], Optional[str]]:
+        if self.login_limiter and not self.login_limiter.allow_ip(client_ip):
+            print(f"login rate limited for {client_ip}")
+            return self._reject_busy()
+        
         try:
             if not body:
                 print("empty login body")
-                return False, PacketBuilder.login_reply(-1), None
+                return False, [LOGIN_FAILED], None
                 
             data = body.decode('utf-8')
             parts = data.strip().split('\n')
             
             if len(parts) < 3:
                 print("invalid login format")
-                return False, PacketBuilder.login_reply(-1), None
+                return False, [LOGIN_FAILED], None
             
             username = parts[0].strip()
             password_md5 = parts[1].strip()
             client_info = parts[2].strip()
             
+            if self.login_limiter and not self.login_limiter.allow_username(username):
+                print(f"login rate limited for {username}")
+                return self._reject_busy()
+            
             print(f"login attempt: {username}")
             print(f"client Info: {client_info}")
             
-            # check in db
-            user_id = self.db_manager.validate_user(username, password_md5)
+            # db lookup and response build are the expensive part, only run a few at once
+            if self.login_limiter and not self.login_limiter.acquire():
+                print(f"login queue full, rejecting {username}")
+                return self._reject_busy()
             
-            if user_id:
-                print(f"{username}: the user is connecteduhh successfullay ({user_id})")
-                
-                token = f"osutokenv1_{username}_{user_id}"
-                user_data = UserData(user_id, username)
-                self.token_manager.add_user(token, user_data)
-                
-                response_data = self._build_login_response(user_id, username)
-                return True, response_data, token
-            else:
-                print(f"login fail for {username}: wrong pw")
-                return False, PacketBuilder.login_reply(-1), None
+            try:
+                return self._authenticate(username, password_md5)
+            finally:
+                if self.login_limiter:
+                    self.login_limiter.release()
                 
         except Exception as e:
             print(f"login error: {e}")
-            return False, PacketBuilder.login_reply(-1), None
+            return False, [LOGIN_FAILED], None
     
-    def _build_login_response(self, user_id: int, username: str) -> bytes:
-        response_data = bytearray()
+    def _authenticate(self, username: str, password_md5: str) -> tuple[bool, List[bytes], Optional[str]]:
+        # check in db
+        user_id = self.db_manager.validate_user(username, password_md5)
         
-        response_data.extend(PacketBuilder.protocol_negotiation(19))
-        
-        response_data.extend(PacketBuilder.login_reply(user_id))
-        
-        response_data.extend(PacketBuilder.login_permissions(4))
-        
-        response_data.extend(PacketBuilder.user_presence(
-            user_id, username, 5, 94, 4, 0, 0.0, 0.0, 2100))
+        if user_id:
+            print(f"{username}: the user is connecteduhh successfullay ({user_id})")
             
-        response_data.extend(PacketBuilder.user_stats(
-            user_id, 0, "Idle", "", 0, 0, 0,
-            ranked_score=5000000,
-            accuracy=97.54,
-            playcount=123,
-            total_score=8000000,
-            rank=2100,
-            pp=2100))
-
-        online_users = self.token_manager.get_active_users()
-        other_user_ids = []
-        
-        for token, other_user in online_users.items():
-            if other_user.user_id != user_id:
-                other_user_ids.append(other_user.user_id)
-                # send presence for each online user
-                response_data.extend(PacketBuilder.user_presence(
-                    other_user.user_id, other_user.username, 5, 94, 4, 0, 0.0, 0.0, 2100))
-                # send stats for each online user
-                response_data.extend(PacketBuilder.user_stats(
-                    other_user.user_id, other_user.status, other_user.status_text, 
-                    other_user.beatmap_md5, other_user.mods, other_user.mode, 
-                    other_user.beatmap_id, ranked_score=5000000, accuracy=97.54,
-                    playcount=123, total_score=8000000, rank=2100, pp=2100))
+            user_data = UserData(user_id, username, friends=self.db_manager.get_friends(user_id))
+            
+            # build first, a response that fails to encode must not kick the user's current session
+            response_data = self._build_login_response(user_id, username, user_data.friends)
+            token = self.token_manager.add_user(user_data)
+            return True, response_data, token
+        else:
+            print(f"login fail for {username}: wrong pw")
+            return False, [LOGIN_FAILED], None
+    
+    def _build_login_response(self, user_id: int, username: str, friends: Set[int] = frozenset()) -> List[bytes]:
+        # a list of segments written out with one scatter/gather send, nothing gets joined
+        response_segments = [
+            PROTOCOL_NEGOTIATION,
+            PacketBuilder.login_reply(user_id),
+            LOGIN_PERMISSIONS,
+            PacketBuilder.user_presence(user_id, username, 5, 94, 4, 0, 0.0, 0.0, 2100),
+            PacketBuilder.user_stats(
+                user_id, 0, "Idle", "", 0, 0, 0,
+                ranked_score=5000000,
+                accuracy=97.54,
+                playcount=123,
+                total_score=8000000,
+                rank=2100,
+                pp=2100),
+        ]
+
+        # presence and stats for the online users this client gets in full
+        other_user_ids, presence_packets = online_presence(self.token_manager, user_id, friends, self.presence_filter)
+        response_segments.extend(presence_packets)
 
         # send user presence bundle with everything
         if other_user_ids:
-            response_data.extend(PacketBuilder.user_presence_bundle(other_user_ids))
+            response_segments.append(PacketBuilder.user_presence_bundle(other_user_ids))
 
         # homies
-        response_data.extend(PacketBuilder.friends_list([]))
+        response_segments.append(PacketBuilder.friends_list(sorted(friends)) if friends else EMPTY_FRIENDS_LIST)
         
         # channelz
-        main_channel = Channel("#osu", "Main chat", len(online_users) + 1, False)
-        auto_join_channel = Channel("#osu", "Main chat", len(online_users) + 1, True)
-        
-        response_data.extend(PacketBuilder.channel_join_success("#osu"))
+        response_segments.append(channel_segment(len(other_user_ids) + 1))
         
-        response_data.extend(PacketBuilder.channel_available(main_channel))
-        response_data.extend(PacketBuilder.channel_available(auto_join_channel))
-        response_data.extend(PacketBuilder.channel_info_complete())
+        # recent chat in the channels the client was just put in
+        if self.chat_log:
+            for name, description in LOGIN_CHANNELS:
+                response_segments.extend(channel_backfill(self.chat_log, name))
         
-        return bytes(response_data)
+        return response_segments
 
 
-# In handlers.py
-class PacketHandler:
+class PacketEntry:
+    __slots__ = ('packet_id', 'handler', 'decoder', 'count', 'total_bytes')
     
-    def _handle_ping(self, user: UserData, data: bytes) -> bytes:
-        return PacketBuilder.pong()
+    def __init__(self, packet_id: int, handler: Callable, decoder: Callable):
+        self.packet_id = packet_id
+        self.handler = handler
+        self.decoder = decoder
+        self.count = 0
+        self.total_bytes = 0
+
+
+# client packet id -> entry, filled in by @packet on the PacketHandler methods
+PACKET_TABLE: Dict[int, PacketEntry] = {}
+
+
+def packet(packet_id: int, decoder: Callable = PacketReader.empty):
+    def register(handler: Callable) -> Callable:
+        PACKET_TABLE[packet_id] = PacketEntry(packet_id, handler, decoder)
+        return handler
+    return register
+
+
+def packet_stats() -> Dict[int, tuple]:
+    return {packet_id: (entry.handler.__name__, entry.count, entry.total_bytes)
+            for packet_id, entry in PACKET_TABLE.items() if entry.count}
+
+
+class PacketHandler:
+    # stateless apart from the token manager, one instance serves every request
     
-    def __init__(self, token_manager):
+    def __init__(self, token_manager, db_manager=None, presence_filter=False, chat_log=None):
         self.token_manager = token_manager
-        self.packet_handlers = {
-            0: self._handle_change_status,
-            2: self._handle_status_update,
-            3: self._handle_request_status_update,
-            4: self._handle_pong,
-            25: self._handle_send_message,
-            63: self._handle_join_channel,
-            79: self._handle_receive_updates,
-            85: self._handle_stats_request,
-           
-        }
+        self.db_manager = db_manager
+        self.chat_log = chat_log
+        # see LoginHandler, clients ask for everyone else with packets 3/85
+        self.presence_filter = presence_filter
     
     def process_packets(self, user: UserData, body: bytes) -> bytes:
         response_packets = bytearray()
         
-        if not body:
-            return bytes(response_packets)
-        
-        stream = io.BytesIO(body)
+        view = memoryview(body)
+        offset = 0
+        end = len(body)
+        header = PacketReader.HEADER
+        table = PACKET_TABLE
         
-        while stream.tell() < len(body):
-            try:
-                remaining = len(body) - stream.tell()
-                if remaining < 7:  
-                    break
-                
-                packet_id_bytes = stream.read(2)
-                if len(packet_id_bytes) < 2:
-                    break
-                    
-                packet_id = struct.unpack('<H', packet_id_bytes)[0]
-                compression = struct.unpack('<B', stream.read(1))[0]
-                length = struct.unpack('<I', stream.read(4))[0]
-                
-                if length > remaining - 7: 
-                    print(f"invalid packet length: {length}, remaining: {remaining}")
-                    break
-                    
-                data = stream.read(length)
-                
-                print(f"received packet: ID={packet_id}, Length={length}")
-                
-                if packet_id in self.packet_handlers:
-                    response = self.packet_handlers[packet_id](user, data)
-                    if response:
-                        response_packets.extend(response)
-                else:
-                    print(f"unhandled packet ID: {packet_id}")
-                    
-            except struct.error as e:
-                print(f"error parsing packet: {e}")
+        while end - offset >= 7:
+            packet_id, compression, length = header.unpack_from(view, offset)
+            offset += 7
+            
+            if length > end - offset:
+                print(f"invalid packet length: {length}, remaining: {end - offset}")
                 break
+            
+            entry = table.get(packet_id)
+            if entry is None:
+                offset += length
+                continue
+            
+            data = view[offset:offset + length]
+            offset += length
+            entry.count += 1
+            entry.total_bytes += length
+            
+            try:
+                response = entry.handler(self, user, *entry.decoder(data))
             except Exception as e:
-                print(f"error processing packet: {e}")
-                break
+                print(f"error processing packet {packet_id}: {e}")
+                continue
+            
+            if response:
+                response_packets.extend(response)
         
         return bytes(response_packets)
     
-    def _broadcast_to_all_users(self, packet_data: bytes, exclude_user: Optional[UserData] = None) -> bytes:
+    def _broadcast_to_all_users(self, packet_data: bytes, exclude_user: Optional[UserData] = None) -> None:
+        exclude_user_id = exclude_user.user_id if exclude_user else None
+        self.token_manager.enqueue_all(packet_data, exclude_user_id)
+    
+    def _broadcast_to_channel(self, channel_name: str, message_packet: bytes, exclude_user: Optional[UserData] = None) -> None:
+        # only #osu exists and everyone is in it
+        exclude_user_id = exclude_user.user_id if exclude_user else None
+        self.token_manager.enqueue_all(message_packet, exclude_user_id)
+    
+    def _stats_for(self, user: UserData, user_ids: List[int]) -> bytes:
         response_packets = bytearray()
         
-        for token, user_data in self.token_manager.get_active_users().items():
-            if exclude_user and user_data.user_id == exclude_user.user_id:
-                continue
-            response_packets.extend(packet_data)
+        for active_user in self.token_manager.get_users_by_ids(user_ids):
+            # with the presence filter on this may be the first the client hears of them,
+            # and from now on their status changes are queued for this client too
+            if self.presence_filter:
+                response_packets.extend(user_presence_packet(active_user))
+                user.watching.add(active_user.user_id)
+            response_packets.extend(user_stats_packet(active_user))
         
         return bytes(response_packets)
     
-    def _broadcast_to_channel(self, channel_name: str, message_packet: bytes, exclude_user: Optional[UserData] = None) -> bytes:
-        response_packets = bytearray()
+    @packet(0, PacketReader.change_status)
+    def _handle_change_status(self, user: UserData, status: int, status_text: str, beatmap_md5: str,
+                              mods: int, mode: int, beatmap_id: int) -> Optional[bytes]:
+        print(f"update from: {user.username}: {status} - {status_text}")
         
-        for token, user_data in self.token_manager.get_active_users().items():
-            if exclude_user and user_data.user_id == exclude_user.user_id:
-                continue 
-            response_packets.extend(message_packet)
+        user.status = status
+        user.status_text = status_text
+        user.beatmap_md5 = beatmap_md5
+        user.mods = mods
+        user.mode = mode
+        user.beatmap_id = beatmap_id
         
-        return bytes(response_packets)
+        if self.presence_filter:
+            # only friends and clients that asked for this user (3/85) get the update
+            self.token_manager.enqueue_interested(user_stats_packet(user), user.user_id)
+        else:
+            self._broadcast_to_all_users(user_stats_packet(user), exclude_user=user)
+        return None
     
-    def _handle_change_status(self, user: UserData, data: bytes) -> Optional[bytes]:
-        try:
-            stream = io.BytesIO(data)
-            status = struct.unpack('<B', stream.read(1))[0]
-            status_text = BanchoProtocol.read_bancho_string_from_stream(stream)
-            beatmap_md5 = BanchoProtocol.read_bancho_string_from_stream(stream)
-            mods = struct.unpack('<I', stream.read(4))[0]
-            mode = struct.unpack('<B', stream.read(1))[0]
-            beatmap_id = struct.unpack('<i', stream.read(4))[0]
-            
-            print(f"update from: {user.username}: {status} - {status_text}")
-            
-            user.status = status
-            user.status_text = status_text
-            user.beatmap_md5 = beatmap_md5
-            user.mods = mods
-            user.mode = mode
-            user.beatmap_id = beatmap_id
-            
-            stats_packet = PacketBuilder.user_stats(
-                user.user_id, status, status_text, beatmap_md5, mods, mode, beatmap_id,
-                ranked_score=5000000, accuracy=97.54, playcount=123,
-                total_score=8000000, rank=2100, pp=2100)
-            
-            return self._broadcast_to_all_users(stats_packet, exclude_user=user)
-            
-        except Exception as e:
-            print(f"error handling status change :  {e}")
+    @packet(2)
+    def _handle_status_update(self, user: UserData) -> Optional[bytes]:
+        print(f"Deprecated status update from {user.username}")
+        return None
+    
+    @packet(3, PacketReader.int_list)
+    def _handle_request_status_update(self, user: UserData, user_ids: List[int]) -> Optional[bytes]:
+        print(f"status update request from {user.username} for users(s): {user_ids}")
+        return self._stats_for(user, user_ids)
+    
+    @packet(4)
+    def _handle_pong(self, user: UserData) -> Optional[bytes]:
+        return None
+    
+    @packet(25, PacketReader.send_message)
+    def _handle_send_message(self, user: UserData, target: str, message: str, sending_client: str) -> Optional[bytes]:
+        print(f"[Send Message] {user.username} -> {target}: {message}")
+        
+        if target.startswith("#"):
+            message_packet = PacketBuilder.send_message(target, message, user.username, user.user_id)
+            self._broadcast_to_channel(target, message_packet, exclude_user=user)
+            if self.chat_log:
+                self.chat_log.append(Message(user.username, user.user_id, target, message))
         
         return None
     
-    def _handle_request_status_update(self, user: UserData, data: bytes) -> Optional[bytes]:
-        try:
-            stream = io.BytesIO(data)
-            user_ids = BanchoProtocol.read_int_list_from_stream(stream)
-            
-            print(f"status update request from {user.username} for users(s): {user_ids}")
-            
-            response_packets = bytearray()
-            
-            for requested_user_id in user_ids:
-                for token, active_user in self.token_manager.get_active_users().items():
-                    if active_user.user_id == requested_user_id:
-                        stats_packet = PacketBuilder.user_stats(
-                            active_user.user_id, active_user.status, active_user.status_text,
-                            active_user.beatmap_md5, active_user.mods, active_user.mode,
-                            active_user.beatmap_id, ranked_score=5000000, accuracy=97.54,
-                            playcount=123, total_score=8000000, rank=2100, pp=2100)
-                        response_packets.extend(stats_packet)
-                        break
-            
-            return bytes(response_packets)
-            
-        except Exception as e:
-            print(f"request handle error: {e}")
+    @packet(63, PacketReader.string)
+    def _handle_join_channel(self, user: UserData, channel_name: str) -> Optional[bytes]:
+        print(f"{user.username} wants to join channel: {channel_name}")
         
+        if channel_name == "#osu":
+            # no backfill here: login already sent it and the queue has carried everything since
+            return PacketBuilder.channel_join_success(channel_name)
         return None
     
-    def _handle_stats_request(self, user: UserData, data: bytes) -> Optional[bytes]:
-        try:
-            stream = io.BytesIO(data)
-            user_ids = BanchoProtocol.read_int_list_from_stream(stream)
-            
-            print(f"stat request from {user.username} for user(s): {user_ids}")
-            
-            response_packets = bytearray()
-            
-            for requested_user_id in user_ids:
-                user_found = False
-                for token, active_user in self.token_manager.get_active_users().items():
-                    if active_user.user_id == requested_user_id:
-                        stats_packet = PacketBuilder.user_stats(
-                            active_user.user_id, active_user.status, active_user.status_text,
-                            active_user.beatmap_md5, active_user.mods, active_user.mode,
-                            active_user.beatmap_id, ranked_score=5000000, accuracy=97.54,
-                            playcount=123, total_score=8000000, rank=2100, pp=2100)
-                        response_packets.extend(stats_packet)
-                        user_found = True
-                        break
-                
-            
-            return bytes(response_packets)
-            
-        except Exception as e:
-            print(f"stat request error: {e}")
+    @packet(73, PacketReader.int32)
+    def _handle_friend_add(self, user: UserData, friend_id: int) -> Optional[bytes]:
+        # ids go out as unsigned ints in the friends list, anything else breaks every later login
+        if friend_id <= 0 or friend_id == user.user_id or friend_id in user.friends:
+            return None
+        if self.db_manager and not self.db_manager.get_user_info(friend_id):
+            print(f"{user.username} tried to add unknown user {friend_id}")
+            return None
         
+        print(f"{user.username} added friend {friend_id}")
+        user.friends.add(friend_id)
+        if self.db_manager:
+            self.db_manager.add_friend(user.user_id, friend_id)
         return None
     
-    def _handle_receive_updates(self, user: UserData, data: bytes) -> Optional[bytes]:
-        print(f"receive updates request from {user.username}")
+    @packet(74, PacketReader.int32)
+    def _handle_friend_remove(self, user: UserData, friend_id: int) -> Optional[bytes]:
+        if friend_id not in user.friends:
+            return None
         
-        response_packets = bytearray()
-        online_user_ids = []
+        print(f"{user.username} removed friend {friend_id}")
+        user.friends.discard(friend_id)
+        if self.db_manager:
+            self.db_manager.remove_friend(user.user_id, friend_id)
+        return None
+    
+    @packet(79)
+    def _handle_receive_updates(self, user: UserData) -> Optional[bytes]:
+        print(f"receive updates request from {user.username}")
         
-        for token, online_user in self.token_manager.get_active_users().items():
-            if online_user.user_id != user.user_id:
-                online_user_ids.append(online_user.user_id)
-                
-                # send presence
-                response_packets.extend(PacketBuilder.user_presence(
-                    online_user.user_id, online_user.username, 5, 94, 4, 0, 0.0, 0.0, 2100))
-                
-                # send stats
-                response_packets.extend(PacketBuilder.user_stats(
-                    online_user.user_id, online_user.status, online_user.status_text,
-                    online_user.beatmap_md5, online_user.mods, online_user.mode,
-                    online_user.beatmap_id, ranked_score=5000000, accuracy=97.54,
-                    playcount=123, total_score=8000000, rank=2100, pp=2100))
+        online_user_ids, presence_packets = online_presence(self.token_manager, user.user_id,
+                                                            user.friends, self.presence_filter)
+        response_packets = bytearray(b''.join(presence_packets))
         
         # send user presence bundle
         if online_user_ids:
@@ -309,64 +376,166 @@ class PacketHandler:
         
         return bytes(response_packets)
     
-    def _handle_join_channel(self, user: UserData, data: bytes) -> Optional[bytes]:
-        try:
-            channel_name = BanchoProtocol.read_bancho_string(data)
-            print(f"{user.username} wants to join channel: {channel_name}")
-            
-            if channel_name == "#osu":
-                return PacketBuilder.channel_join_success(channel_name)
-        except Exception as e:
-            print(f"channel join error: {e}")
-        
-        return None
+    @packet(85, PacketReader.int_list)
+    def _handle_stats_request(self, user: UserData, user_ids: List[int]) -> Optional[bytes]:
+        print(f"stat request from {user.username} for user(s): {user_ids}")
+        return self._stats_for(user, user_ids)
 
-    def _handle_send_message(self, user: UserData, data: bytes) -> Optional[bytes]:
-        try:
-            stream = io.BytesIO(data)
-            target = BanchoProtocol.read_bancho_string_from_stream(stream)
-            message = BanchoProtocol.read_bancho_string_from_stream(stream)
-            sending_client = BanchoProtocol.read_bancho_string_from_stream(stream)
-        
-            print(f"[Send Message] {user.username} -> {target}: {message}")
-        
-            if target.startswith("#"):
-                message_packet = PacketBuilder.send_message(target, message, user.username, user.user_id)
-                return self._broadcast_to_channel(target, message_packet, exclude_user=user)
-                
-        except Exception as e:
-            print(f"Error handling send message: {e}")
+
+class TokenManager:
     
-        return None
+    # packets queued for a session that stops polling are dropped past this
+    MAX_QUEUE_BYTES = 1024 * 1024
+    # a session that has not polled for this long is dropped, its client has gone away
+    SESSION_TIMEOUT = 120
+    # idle sessions are looked for on logins and broadcasts, at most this often
+    SWEEP_INTERVAL = 10
+    # sessions are keyed by the raw token, clients see it hex encoded
+    TOKEN_BYTES = 16
     
-    def _handle_status_update(self, user: UserData, data: bytes) -> Optional[bytes]:
-        print(f"Deprecated status update from {user.username}")
-        return None
+    def __init__(self, max_sessions_per_user: int = 1):
+        # a new login past this limit kicks the user's oldest session
+        self.max_sessions_per_user = max_sessions_per_user
+        self.active_tokens: Dict[bytes, UserData] = {}
+        self.packet_queues: Dict[bytes, bytearray] = {}
+        self.user_sessions: Dict[int, List[bytes]] = {}
+        self.last_poll: Dict[bytes, float] = {}
+        self.last_sweep = time.monotonic()
+        # requests are served from several threads (and from the broker in cluster mode)
+        self.lock = threading.RLock()
     
-    def _handle_pong(self, user: UserData, data: bytes) -> Optional[bytes]:
-        print(f"pong from {user.username}")
-        return None
-
-
-class TokenManager:
+    def _key(self, token: str) -> Optional[bytes]:
+        if not token or len(token) != self.TOKEN_BYTES * 2:
+            return None
+        try:
+            return bytes.fromhex(token)
+        except ValueError:
+            return None
+    
+    def _add_session(self, key: bytes, user_data: UserData, queue: bytes = b''):
+        sessions = self.user_sessions.get(user_data.user_id, [])
+        while sessions and len(sessions) >= self.max_sessions_per_user:
+            self._remove_session(sessions[0])
+            print(f"kicked old session of {user_data.username}")
+        self.user_sessions.setdefault(user_data.user_id, []).append(key)
+        self.active_tokens[key] = user_data
+        self.packet_queues[key] = bytearray(queue)
+        self.last_poll[key] = time.monotonic()
     
-    def __init__(self):
-        self.active_tokens: Dict[str, UserData] = {}
+    def _remove_session(self, key: bytes) -> Optional[UserData]:
+        user = self.active_tokens.pop(key, None)
+        self.packet_queues.pop(key, None)
+        self.last_poll.pop(key, None)
+        if user:
+            sessions = self.user_sessions.get(user.user_id, [])
+            if key in sessions:
+                sessions.remove(key)
+            if not sessions:
+                self.user_sessions.pop(user.user_id, None)
+        return user
     
-    def add_user(self, token: str, user_data: UserData):
-        self.active_tokens[token] = user_data
+    def _expire_idle(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_sweep < self.SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        
+        idle = [key for key, polled_at in self.last_poll.items() if now - polled_at > self.SESSION_TIMEOUT]
+        for key in idle:
+            user = self._remove_session(key)
+            if user:
+                print(f"expired idle session: {user.username} (total: {len(self.active_tokens)})")
+    
+    def add_user(self, user_data: UserData) -> str:
+        key = secrets.token_bytes(self.TOKEN_BYTES)
+        with self.lock:
+            self._expire_idle()
+            self._add_session(key, user_data)
         print(f"new user session: {user_data.username} (total: {len(self.active_tokens)})")
+        return key.hex()
 
     
     def get_user(self, token: str) -> Optional[UserData]:
-        return self.active_tokens.get(token)
+        key = self._key(token)
+        return self.active_tokens.get(key) if key else None
+    
+    def update_user(self, token: str, user_data: UserData):
+        # in-process the handlers mutate the stored object directly, this matters
+        # when the manager sits behind a proxy and callers hold a copy
+        key = self._key(token)
+        with self.lock:
+            if key in self.active_tokens:
+                self.active_tokens[key] = user_data
     
     def remove_user(self, token: str):
-        if token in self.active_tokens:
-            user = self.active_tokens[token]
-            del self.active_tokens[token]
+        key = self._key(token)
+        with self.lock:
+            user = self._remove_session(key) if key else None
+        if user:
             print(f"removed user session: {user.username} (total: {len(self.active_tokens)})")
             
     
-    def get_active_users(self) -> Dict[str, UserData]:
-        return self.active_tokens.copy()
\ No newline at end of file
+    def get_active_users(self) -> Dict[bytes, UserData]:
+        with self.lock:
+            return self.active_tokens.copy()
+    
+    def get_users_by_ids(self, user_ids) -> List[UserData]:
+        # newest session per user, ids that are not online are skipped
+        with self.lock:
+            return [self.active_tokens[self.user_sessions[user_id][-1]]
+                    for user_id in user_ids if user_id in self.user_sessions]
+    
+    def get_online_user_ids(self) -> List[int]:
+        with self.lock:
+            return list(self.user_sessions)
+    
+    def _enqueue(self, key: bytes, packet_data: bytes):
+        queue = self.packet_queues.get(key)
+        if queue is not None and len(queue) + len(packet_data) <= self.MAX_QUEUE_BYTES:
+            queue.extend(packet_data)
+    
+    def enqueue_all(self, packet_data: bytes, exclude_user_id: Optional[int] = None):
+        with self.lock:
+            self._expire_idle()
+            for key, user_data in self.active_tokens.items():
+                if user_data.user_id != exclude_user_id:
+                    self._enqueue(key, packet_data)
+    
+    def enqueue_interested(self, packet_data: bytes, user_id: int):
+        # presence filter fan-out, a set lookup per session instead of a queued copy for everyone
+        with self.lock:
+            self._expire_idle()
+            for key, user_data in self.active_tokens.items():
+                if user_data.user_id != user_id and (user_id in user_data.friends or user_id in user_data.watching):
+                    self._enqueue(key, packet_data)
+    
+    def export_sessions(self) -> List[tuple]:
+        with self.lock:
+            # abandoned sessions and their full queues are not worth restoring
+            self._expire_idle(force=True)
+            return [(key, user_data, bytes(self.packet_queues.get(key, b'')))
+                    for key, user_data in self.active_tokens.items()]
+    
+    def import_sessions(self, sessions: List[tuple]):
+        with self.lock:
+            for key, user_data, queue in sessions:
+                self._add_session(key, user_data, queue)
+        print(f"restored {len(sessions)} session(s) (total: {len(self.active_tokens)})")
+    
+    def finish_poll(self, token: str, user_data: UserData) -> bytes:
+        # update_user and dequeue in one call, one broker round trip per poll instead of two
+        self.update_user(token, user_data)
+        return self.dequeue(token)
+    
+    def dequeue(self, token: str) -> bytes:
+        key = self._key(token)
+        with self.lock:
+            queue = self.packet_queues.get(key) if key else None
+            if queue is not None:
+                # every poll ends here, so this doubles as the session's keepalive
+                self.last_poll[key] = time.monotonic()
+            if not queue:
+                return b''
+            data = bytes(queue)
+            queue.clear()
+            return data
@@ -1,5 +1,9 @@
 from http.server import BaseHTTPRequestHandler
-from handlers import LoginHandler, PacketHandler, TokenManager
+from typing import List
+from handlers import LoginHandler
+
+# stays well under IOV_MAX (1024 on linux)
+SENDMSG_MAX_SEGMENTS = 512
 
 class OsuHTTPRequestHandler(BaseHTTPRequestHandler):
     
@@ -32,18 +36,40 @@ class OsuHTTPRequestHandler(BaseHTTPRequestHandler):
     def _handle_login_request(self, body: bytes):
         login_handler = LoginHandler(
             self.server_instance.db_manager,
-            self.server_instance.token_manager
+            self.server_instance.token_manager,
+            self.server_instance.login_limiter,
+            self.server_instance.presence_filter,
+            self.server_instance.chat_log
         )
         
-        success, response_data, token = login_handler.handle_login(body)
+        success, response_segments, token = login_handler.handle_login(body, self.client_address[0])
         
         self.send_response(200)
         self.send_header('Content-Type', 'application/octet-stream')
         if token:
             self.send_header('cho-token', token)
-        self.send_header('Content-Length', str(len(response_data)))
+        self.send_header('Content-Length', str(sum(len(segment) for segment in response_segments)))
         self.end_headers()
-        self.wfile.write(response_data)
+        self._write_segments(response_segments)
+    
+    def _write_segments(self, segments: List[bytes]):
+        # scatter/gather write, the kernel gets the segments without them being joined first
+        if not hasattr(self.connection, 'sendmsg'):
+            self.wfile.write(b''.join(segments))
+            return
+        
+        pending = [memoryview(segment) for segment in segments if segment]
+        index = 0
+        while index < len(pending):
+            sent = self.connection.sendmsg(pending[index:index + SENDMSG_MAX_SEGMENTS])
+            while sent:
+                size = len(pending[index])
+                if sent >= size:
+                    sent -= size
+                    index += 1
+                else:
+                    pending[index] = pending[index][sent:]
+                    sent = 0
     
     def _handle_authenticated_request(self, osu_token: str, body: bytes):
         user_data = self.server_instance.token_manager.get_user(osu_token)
@@ -56,8 +82,10 @@ class OsuHTTPRequestHandler(BaseHTTPRequestHandler):
         
         print(f"packet from {user_data.username} (ID: {user_data.user_id})")
         
-        packet_handler = PacketHandler(self.server_instance.token_manager)
-        response_packets = packet_handler.process_packets(user_data, body)
+        token_manager = self.server_instance.token_manager
+        response_packets = self.server_instance.packet_handler.process_packets(user_data, body)
+        # stores our changes and hands back anything other sessions broadcast to us since the last poll
+        response_packets += token_manager.finish_poll(osu_token, user_data)
     
         self.send_response(200)
         self.send_header('Content-Type', 'application/octet-stream')
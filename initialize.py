@@ -1,27 +1,175 @@
-import threading
-import subprocess
+import argparse
+import os
 import signal
+import socket
+import subprocess
 import sys
-import os
 import time
+from typing import List, Optional
 
-def run_flask():
-    os.system("flask run")
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-def run_osu_server():
-    os.system("python server.py")
 
-def shutdown(signum, frame):
-    os._exit(0)
+class ManagedProcess:
+    # one child service: started in its own session so only the supervisor sees ctrl+c,
+    # ready once its port accepts connections, restarted with backoff when it dies.
+    # nothing in here blocks, the supervisor loop polls check() for every child in turn
 
-if __name__ == "__main__":
-    signal.signal(signal.SIGINT, shutdown)
+    MIN_BACKOFF = 1.0
+    MAX_BACKOFF = 30.0
+    # a child that stays up this long is considered healthy again
+    STABLE_AFTER = 60.0
+
+    def __init__(self, name: str, command: List[str], host: str, port: int, ready_timeout: float = 30.0):
+        self.name = name
+        self.command = command
+        self.host = host
+        self.port = port
+        self.ready_timeout = ready_timeout
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.ready = False
+        self.ready_deadline: Optional[float] = None
+        self.restarts = 0
+        self.backoff = self.MIN_BACKOFF
+        self.restart_at: Optional[float] = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, cwd=BASE_DIR, start_new_session=True)
+        self.started_at = time.monotonic()
+        self.ready = False
+        self.ready_deadline = self.started_at + self.ready_timeout
+        self.restart_at = None
+        print(f"[supervisor] started {self.name} (pid {self.process.pid})")
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def waiting_for_ready(self) -> bool:
+        return self.ready_deadline is not None
+
+    def port_open(self) -> bool:
+        try:
+            with socket.create_connection((self.host, self.port), timeout=0.1):
+                return True
+        except OSError:
+            return False
+
+    def _poll_ready(self, now: float):
+        if not self.waiting_for_ready():
+            return
+        if self.port_open():
+            self.ready = True
+            self.ready_deadline = None
+            again = " again" if self.restarts else ""
+            print(f"[supervisor] {self.name} ready{again} on port {self.port} in {now - self.started_at:.2f}s")
+        elif now > self.ready_deadline:
+            self.ready_deadline = None
+            print(f"[supervisor] {self.name} not ready on port {self.port} after {self.ready_timeout:.0f}s")
+
+    def check(self):
+        now = time.monotonic()
+        if self.is_running():
+            self._poll_ready(now)
+            if self.ready and now - self.started_at > self.STABLE_AFTER:
+                self.backoff = self.MIN_BACKOFF
+            return
+        if self.process is None:
+            return
+
+        if self.restart_at is None:
+            when = "" if self.ready else " during startup"
+            self.ready_deadline = None
+            print(f"[supervisor] {self.name} exited{when} with code {self.process.returncode}, "
+                  f"restarting in {self.backoff:.0f}s")
+            self.restart_at = now + self.backoff
+            self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+        elif now >= self.restart_at:
+            self.restarts += 1
+            self.start()
+
+    def stop(self, sig: int = signal.SIGTERM):
+        if self.is_running():
+            self.process.send_signal(sig)
+
+    def wait_stopped(self, timeout: float):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            print(f"[supervisor] {self.name} did not drain in {timeout:.0f}s, killing")
+            self.process.kill()
+            self.process.wait()
 
-    flask_thread = threading.Thread(target=run_flask)
-    osu_thread = threading.Thread(target=run_osu_server)
 
-    flask_thread.start()
-    osu_thread.start()
+class Supervisor:
 
-    while True:
-        time.sleep(1)
+    def __init__(self, services: List[ManagedProcess], drain_timeout: float = 10.0):
+        self.services = services
+        self.drain_timeout = drain_timeout
+        self.running = False
+
+    def _handle_signal(self, signum, frame):
+        self.running = False
+
+    def run(self):
+        launched_at = time.monotonic()
+        self.running = True
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+
+        for service in self.services:
+            service.start()
+
+        launch_reported = False
+        try:
+            while self.running:
+                for service in self.services:
+                    service.check()
+
+                if not launch_reported and all(service.ready for service in self.services):
+                    launch_reported = True
+                    print(f"[supervisor] launch to ready: {time.monotonic() - launched_at:.2f}s")
+
+                # poll quickly while something is starting so the ready times mean something
+                waiting = any(service.waiting_for_ready() for service in self.services)
+                time.sleep(0.05 if waiting else 0.5)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        print("[supervisor] draining")
+        # every child gets the signal first so they drain in parallel
+        for service in self.services:
+            service.stop()
+        for service in self.services:
+            service.wait_stopped(self.drain_timeout)
+        print("[supervisor] stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run the bancho server and the web app together")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--server-port", type=int, default=13381)
+    parser.add_argument("--web-port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=1, help="bancho worker processes")
+    parser.add_argument("--presence-filter", action="store_true")
+    args = parser.parse_args()
+
+    server_command = [sys.executable, "server.py", "--host", args.host,
+                      "--port", str(args.server_port), "--workers", str(args.workers)]
+    if args.presence_filter:
+        server_command.append("--presence-filter")
+
+    web_command = [sys.executable, "-m", "flask", "--app", "app", "run",
+                   "--host", args.host, "--port", str(args.web_port)]
+
+    Supervisor([
+        ManagedProcess("bancho", server_command, args.host, args.server_port),
+        ManagedProcess("web", web_command, args.host, args.web_port),
+    ]).run()
+
+
+if __name__ == "__main__":
+    main()
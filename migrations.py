@@ -0,0 +1,123 @@
+import sqlite3
+from typing import List, Tuple
+
+# (version, description, statements). Append only: never edit or reorder a migration that has
+# shipped, add a new one instead. Statements should be safe on a live database, so prefer
+# CREATE ... IF NOT EXISTS and ALTER TABLE ... ADD COLUMN over table rebuilds.
+MIGRATIONS: List[Tuple[int, str, Tuple[str, ...]]] = [
+    (1, "users table", (
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            password_md5 TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    )),
+    (2, "friends table", (
+        '''
+        CREATE TABLE IF NOT EXISTS friends (
+            user_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, friend_id)
+        ) WITHOUT ROWID
+        ''',
+    )),
+    (3, "newest-first user listing index", (
+        '''
+        CREATE INDEX IF NOT EXISTS idx_users_created_at
+        ON users (created_at DESC, id DESC)
+        ''',
+    )),
+    (4, "chat messages", (
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            target TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL
+        )
+        ''',
+        # channel backfill and moderation search by channel or by sender, newest first
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_target
+        ON messages (target, id DESC)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_sender
+        ON messages (sender COLLATE NOCASE, id DESC)
+        ''',
+    )),
+    (5, "drop friends that are not users", (
+        # friend add used to store any id the client sent, a negative one made logins fail
+        '''
+        DELETE FROM friends
+        WHERE friend_id <= 0 OR friend_id NOT IN (SELECT id FROM users)
+        ''',
+    )),
+    (6, "chat message text index", (
+        # trigram tokens keep the substring semantics the moderation search had with LIKE
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id', tokenize='trigram'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''',
+        # index whatever was logged before this migration
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    )),
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchall()[0][0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    applied = 0
+
+    for version, description, statements in MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+
+        # the write lock makes a second process (server vs web app) wait, then see the new version
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version <= schema_version(conn):
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        print(f"db migration {version} applied: {description}")
+        applied += 1
+
+    if applied:
+        # fresh statistics for the planner after schema changes
+        conn.execute('ANALYZE')
+    conn.execute('PRAGMA optimize')
+    return applied
@@ -1,8 +1,9 @@
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Optional, Set
 from datetime import datetime
 
-@dataclass
+# slotted, there is one of these per live session and broadcasts read them constantly
+@dataclass(slots=True)
 class UserData:
     user_id: int
     username: str
@@ -12,25 +13,28 @@ class UserData:
     mods: int = 0
     mode: int = 0  # 0=osu!, 1=Taiko, 2=CtB, 3=osu!mania
     beatmap_id: int = 0
+    friends: Set[int] = field(default_factory=set)  # loaded at login, kept in sync by friend add/remove
+    watching: Set[int] = field(default_factory=set)  # users this client asked stats for (3/85), presence filter only
     
     def __str__(self):
         return f"User({self.username}, ID: {self.user_id}, Status: {self.status})"
 
-@dataclass
+@dataclass(slots=True)
 class UserInfo:
     id: int
     username: str
     created_at: str
     
-@dataclass
+@dataclass(slots=True)
 class Message:
     sender: str
     sender_id: int
     target: str
     content: str
     timestamp: Optional[datetime] = None
+    id: Optional[int] = None  # set once the message is in the chat log table
     
-@dataclass
+@dataclass(slots=True)
 class Channel:
     name: str
     description: str
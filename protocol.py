@@ -27,11 +27,9 @@ class BanchoProtocol:
     
     @staticmethod
     def write_int_list(int_list: List[int]) -> bytes:
-        result = bytearray()
-        result.extend(struct.pack('<H', len(int_list)))
-        for item in int_list:
-            result.extend(struct.pack('<I', item))
-        return bytes(result)
+        # one pack for the count and every element, presence bundles carry the whole online list
+        count = len(int_list)
+        return struct.pack(f'<H{count}I', count, *int_list)
     
     @staticmethod
     def read_int_list_from_stream(stream: io.BytesIO) -> List[int]:
@@ -40,14 +38,14 @@ class BanchoProtocol:
             return []
         
         length = struct.unpack('<H', length_bytes)[0]
-        int_list = []
+        start = stream.tell()
         
-        for _ in range(length):
-            int_bytes = stream.read(4)
-            if len(int_bytes) < 4:
-                break
-            int_list.append(struct.unpack('<I', int_bytes)[0])
+        # unpack straight out of the stream buffer instead of reading 4 bytes at a time
+        with stream.getbuffer() as view:
+            count = min(length, (len(view) - start) // 4)
+            int_list = list(struct.unpack_from(f'<{count}I', view, start))
         
+        stream.seek(start + count * 4)
         return int_list
     
     @staticmethod
@@ -86,12 +84,92 @@ class BanchoProtocol:
         string_bytes = stream.read(length)
         return string_bytes.decode('utf-8')
     
+    @staticmethod
+    def read_bancho_string_at(data, offset: int) -> tuple[str, int]:
+        # buffer variant of read_bancho_string_from_stream, returns the string and the next offset
+        if offset >= len(data):
+            return "", offset
+        
+        marker = data[offset]
+        offset += 1
+        
+        if marker == 0x00:
+            return "", offset
+        
+        if marker != 0x0b:
+            raise ValueError(f"Unexpected Bancho string marker: {marker}")
+        
+        length = 0
+        shift = 0
+        
+        while True:
+            b = data[offset]
+            offset += 1
+            length |= (b & 0x7F) << shift
+            if (b & 0x80) == 0:
+                break
+            shift += 7
+        
+        end = offset + length
+        return str(data[offset:end], 'utf-8'), end
+    
+    @staticmethod
+    def read_int_list_at(data, offset: int) -> tuple[List[int], int]:
+        if len(data) - offset < 2:
+            return [], offset
+        
+        length = struct.unpack_from('<H', data, offset)[0]
+        offset += 2
+        count = min(length, (len(data) - offset) // 4)
+        int_list = list(struct.unpack_from(f'<{count}I', data, offset))
+        return int_list, offset + count * 4
+    
     @staticmethod
     def create_packet(packet_id: int, content: bytes) -> bytes:
         compression = 0
         return struct.pack('<HbI', packet_id, compression, len(content)) + content
 
 
+class PacketReader:
+    # payload decoders for client packets, each returns the handler's arguments as a tuple
+    
+    HEADER = struct.Struct('<HBI')
+    STATUS_HEAD = struct.Struct('<B')
+    STATUS_TAIL = struct.Struct('<IBi')
+    INT32 = struct.Struct('<i')
+    
+    @staticmethod
+    def empty(data) -> tuple:
+        return ()
+    
+    @staticmethod
+    def string(data) -> tuple:
+        return (BanchoProtocol.read_bancho_string_at(data, 0)[0],)
+    
+    @staticmethod
+    def int32(data) -> tuple:
+        return PacketReader.INT32.unpack_from(data, 0)
+    
+    @staticmethod
+    def int_list(data) -> tuple:
+        return (BanchoProtocol.read_int_list_at(data, 0)[0],)
+    
+    @staticmethod
+    def change_status(data) -> tuple:
+        status = PacketReader.STATUS_HEAD.unpack_from(data, 0)[0]
+        status_text, offset = BanchoProtocol.read_bancho_string_at(data, 1)
+        beatmap_md5, offset = BanchoProtocol.read_bancho_string_at(data, offset)
+        mods, mode, beatmap_id = PacketReader.STATUS_TAIL.unpack_from(data, offset)
+        return status, status_text, beatmap_md5, mods, mode, beatmap_id
+    
+    @staticmethod
+    def send_message(data) -> tuple:
+        target, offset = BanchoProtocol.read_bancho_string_at(data, 0)
+        message, offset = BanchoProtocol.read_bancho_string_at(data, offset)
+        sending_client, offset = BanchoProtocol.read_bancho_string_at(data, offset)
+        return target, message, sending_client
+
+
 class PacketBuilder:
     
     @staticmethod
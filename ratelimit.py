@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+
+class TokenBucket:
+
+    # past this many keys the least recently seen one is dropped, a spray of new keys can't grow it
+    MAX_KEYS = 10000
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets: OrderedDict[str, List[float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.MAX_KEYS:
+                    self.buckets.popitem(last=False)
+                bucket = self.buckets[key] = [self.capacity, now]
+            else:
+                self.buckets.move_to_end(key)
+
+            tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1.0:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1.0
+            return True
+
+
+class LoginLimiter:
+
+    def __init__(self, ip_rate: float = 1.0, ip_burst: int = 10,
+                 user_rate: float = 0.2, user_burst: int = 5,
+                 max_concurrent: int = 4, max_waiting: int = 16, queue_timeout: float = 1.0):
+        self.ip_buckets = TokenBucket(ip_rate, ip_burst)
+        self.user_buckets = TokenBucket(user_rate, user_burst)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        # running plus waiting, like the web app's hashing queue
+        self.queue = threading.BoundedSemaphore(max_concurrent + max_waiting)
+        self.queue_timeout = queue_timeout
+
+    def allow_ip(self, ip: str) -> bool:
+        return self.ip_buckets.allow(ip)
+
+    def allow_username(self, username: str) -> bool:
+        return self.user_buckets.allow(username.lower())
+
+    def acquire(self) -> bool:
+        # waits briefly for a login slot, past max_waiting a flood is rejected without waiting at all
+        if not self.queue.acquire(blocking=False):
+            return False
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            self.queue.release()
+            return False
+        return True
+
+    def release(self):
+        self.slots.release()
+        self.queue.release()
@@ -1,34 +1,64 @@
+import argparse
 import threading
 import signal
 import sys
-from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
 from database import DatabaseManager
-from handlers import TokenManager
+from handlers import TokenManager, PacketHandler, packet_stats
 from http_server import OsuHTTPRequestHandler
+from snapshot import save_snapshot, load_snapshot
+from ratelimit import LoginLimiter
+from chat import ChatLog
+
+
+class BanchoHTTPServer(ThreadingHTTPServer):
+    # the default backlog of 5 resets connections during reconnect storms
+    request_queue_size = 128
+
+
+class ReusePortHTTPServer(BanchoHTTPServer):
+    # lets several worker processes bind the same port, the kernel spreads connections
+    allow_reuse_port = True
+
 
 class OsuServer:
     
-    def __init__(self, host='127.0.0.1', port=13381):
+    def __init__(self, host='127.0.0.1', port=13381, token_manager=None, reuse_port=False, print_stats=True,
+                 snapshot_path='sessions.snapshot', presence_filter=False, chat_log=None, login_limiter=None):
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port
+        self.snapshot_path = snapshot_path
+        self.presence_filter = presence_filter
         self.server = None
         self.server_thread = None
         self.running = False
         
         self.db_manager = DatabaseManager()
-        self.token_manager = TokenManager()
+        self.token_manager = token_manager if token_manager is not None else TokenManager()
+        # cluster workers share the broker's limiter so the budget doesn't scale with --workers
+        self.login_limiter = login_limiter if login_limiter is not None else LoginLimiter()
+        # cluster workers are handed the broker's chat log, a standalone server runs its own
+        self.owns_chat_log = chat_log is None
+        self.chat_log = chat_log if chat_log is not None else ChatLog(self.db_manager)
+        self.packet_handler = PacketHandler(self.token_manager, self.db_manager, presence_filter, self.chat_log)
+        
+        # sessions from the previous run keep their osu-token valid
+        if self.snapshot_path:
+            load_snapshot(self.token_manager, self.snapshot_path)
         
         print(f"Starting server: {host}:{port}")
-        self._print_user_stats()
+        if print_stats:
+            self._print_user_stats()
     
     def _print_user_stats(self):
-        users = self.db_manager.get_all_users()
-        if users:
-            print(f"\nUsers ({len(users)}):")
-            for user in users[:5]:
+        total = self.db_manager.count_users()
+        if total:
+            print(f"\nUsers ({total}):")
+            for user in self.db_manager.get_users_page(limit=5):
                 print(f"  • {user.username} (ID: {user.id})")
-            if len(users) > 5:
-                print(f"  ... and {len(users) - 5} more")
+            if total > 5:
+                print(f"  ... and {total - 5} more")
         else:
             print("no users registered")
         print()
@@ -38,8 +68,12 @@ class OsuServer:
             *args, server_instance=self, **kwargs
         )
         
-        self.server = HTTPServer((self.host, self.port), handler)
+        # threaded so polls keep being answered while logins wait for a slot
+        server_class = ReusePortHTTPServer if self.reuse_port else BanchoHTTPServer
+        self.server = server_class((self.host, self.port), handler)
         self.running = True
+        if self.owns_chat_log:
+            self.chat_log.start()
         
         print(f"server on: http://{self.host}:{self.port}/")
         print("fish eater")
@@ -57,17 +91,38 @@ class OsuServer:
         self.server_thread.start()
     
     def stop(self):
+        was_running = self.running
         self.running = False
         if self.server:
             self.server.shutdown()
             self.server.server_close()
         if self.server_thread:
             self.server_thread.join(timeout=1)
+        if was_running and self.owns_chat_log:
+            self.chat_log.stop()
+        if was_running and self.snapshot_path:
+            save_snapshot(self.token_manager, self.snapshot_path)
+        if was_running:
+            for packet_id, (name, count, total_bytes) in sorted(packet_stats().items()):
+                print(f"  packet {packet_id} {name}: {count} received, {total_bytes} bytes")
         print("stopped")
 
 
 def main():
-    server = OsuServer()
+    parser = argparse.ArgumentParser(description="osu! bancho server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=13381)
+    parser.add_argument("--workers", type=int, default=1, help="experimental: worker processes sharing one session store broker, "
+                             "see benchmark.py --scaling before relying on it")
+    parser.add_argument("--presence-filter", action="store_true",
+                        help="send full presence/stats only for friends and users the client asks for")
+    args = parser.parse_args()
+    
+    if args.workers > 1:
+        from cluster import OsuCluster
+        server = OsuCluster(args.host, args.port, args.workers, presence_filter=args.presence_filter)
+    else:
+        server = OsuServer(args.host, args.port, presence_filter=args.presence_filter)
     
     def signal_handler(sig, frame):
         print("\nstopping")
@@ -75,6 +130,8 @@ def main():
         sys.exit(0)
     
     signal.signal(signal.SIGINT, signal_handler)
+    # supervisors ask for a graceful drain with SIGTERM
+    signal.signal(signal.SIGTERM, signal_handler)
     
     try:
         server.start()
@@ -0,0 +1,103 @@
+import io
+import os
+import struct
+import time
+import zlib
+from typing import List
+from models import UserData
+from handlers import TokenManager
+from protocol import BanchoProtocol
+
+SNAPSHOT_MAGIC = b'OSNP'
+SNAPSHOT_VERSION = 3
+
+# sessions older than this are not worth restoring, the clients have given up on them
+SNAPSHOT_MAX_AGE = 300
+
+
+def encode_sessions(sessions: List[tuple]) -> bytes:
+    body = bytearray()
+    body.extend(struct.pack('<dI', time.time(), len(sessions)))
+
+    for key, user, queue in sessions:
+        body.extend(key)
+        body.extend(struct.pack('<i', user.user_id))
+        body.extend(BanchoProtocol.write_string(user.username))
+        body.extend(struct.pack('<B', user.status))
+        body.extend(BanchoProtocol.write_string(user.status_text))
+        body.extend(BanchoProtocol.write_string(user.beatmap_md5))
+        body.extend(struct.pack('<IBi', user.mods, user.mode, user.beatmap_id))
+        body.extend(BanchoProtocol.write_int_list(sorted(user.friends)))
+        body.extend(struct.pack('<I', len(queue)))
+        body.extend(queue)
+
+    return SNAPSHOT_MAGIC + struct.pack('<H', SNAPSHOT_VERSION) + zlib.compress(bytes(body))
+
+
+def decode_sessions(data: bytes, max_age: float = SNAPSHOT_MAX_AGE) -> List[tuple]:
+    if data[:4] != SNAPSHOT_MAGIC:
+        raise ValueError("not a session snapshot")
+
+    version = struct.unpack('<H', data[4:6])[0]
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version: {version}")
+
+    stream = io.BytesIO(zlib.decompress(data[6:]))
+    saved_at, count = struct.unpack('<dI', stream.read(12))
+
+    if time.time() - saved_at > max_age:
+        print(f"snapshot is {int(time.time() - saved_at)}s old, not restoring")
+        return []
+
+    sessions = []
+    for _ in range(count):
+        key = stream.read(TokenManager.TOKEN_BYTES)
+        user_id = struct.unpack('<i', stream.read(4))[0]
+        username = BanchoProtocol.read_bancho_string_from_stream(stream)
+        status = struct.unpack('<B', stream.read(1))[0]
+        status_text = BanchoProtocol.read_bancho_string_from_stream(stream)
+        beatmap_md5 = BanchoProtocol.read_bancho_string_from_stream(stream)
+        mods, mode, beatmap_id = struct.unpack('<IBi', stream.read(9))
+        friends = set(BanchoProtocol.read_int_list_from_stream(stream))
+        queue_length = struct.unpack('<I', stream.read(4))[0]
+        queue = stream.read(queue_length)
+
+        user = UserData(user_id, username, status, status_text, beatmap_md5, mods, mode, beatmap_id, friends)
+        sessions.append((key, user, queue))
+
+    return sessions
+
+
+def save_snapshot(token_manager, path: str):
+    try:
+        sessions = token_manager.export_sessions()
+        data = encode_sessions(sessions)
+
+        # write next to the target and swap in, a crash mid-write leaves the old file.
+        # owner-only: the file holds live session tokens
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        print(f"saved {len(sessions)} session(s) to {path} ({len(data)} bytes)")
+    except Exception as e:
+        print(f"snapshot save error: {e}")
+
+
+def load_snapshot(token_manager, path: str):
+    if not os.path.exists(path):
+        return
+
+    try:
+        with open(path, 'rb') as f:
+            sessions = decode_sessions(f.read())
+        if sessions:
+            token_manager.import_sessions(sessions)
+    except Exception as e:
+        print(f"snapshot load error: {e}")
+    finally:
+        # a snapshot is only good for the restart right after it was taken
+        os.remove(path)